@@ -1,168 +1,724 @@
 import os
-import requests
-import json
-from dotenv import load_dotenv
-from flask import Flask, request, jsonify, render_template
+import re
+import gzip
+import orjson
+import hashlib
+import secrets
+import time
+import asyncio
+import threading
+from typing import Annotated
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import httpx
+import diskcache
+import numpy as np
+import msgspec
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from flask import Flask, Response, request, render_template
 
-# Load environment variables from .env file
-load_dotenv()
+# --- Logging Setup ---
+# Records go onto a queue and a background listener thread writes them to stderr,
+# so request handlers never block on console I/O.
+_log_queue = queue.Queue(-1)
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    handlers=[QueueHandler(_log_queue)]
+)
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+# httpx logs every request at INFO; keep only its warnings
+logging.getLogger("httpx").setLevel(logging.WARNING)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+logger = logging.getLogger("shopping")
+
+def _load_config():
+    """Loads environment variables from the .env file, unless SKIP_DOTENV=1 (e.g. under tests)."""
+    if os.getenv("SKIP_DOTENV") != "1":
+        from dotenv import load_dotenv  # Imported lazily to keep cold starts fast
+        load_dotenv()
+
+_load_config()
 
 # --- Configuration ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 # Using the standard, stable model which supports search grounding
 GEMINI_MODEL_NAME = "gemini-2.5-flash" 
+# Used to match near-duplicate shopping queries in the semantic cache
+EMBEDDING_MODEL_NAME = "gemini-embedding-001"
 
 # --- Gemini API Setup ---
 if not GEMINI_API_KEY:
     raise ValueError("GEMINI_API_KEY environment variable not set or loaded.")
 
+# Endpoint URLs are built once here rather than on every call. The API key travels in the
+# x-goog-api-key header of the shared client, so it never shows up in URLs, logs or exception messages.
+API_BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
+GENERATE_URL = f"{API_BASE_URL}/models/{GEMINI_MODEL_NAME}:generateContent"
+STREAM_GENERATE_URL = f"{API_BASE_URL}/models/{GEMINI_MODEL_NAME}:streamGenerateContent?alt=sse"
+BATCH_GENERATE_URL = f"{API_BASE_URL}/models/{GEMINI_MODEL_NAME}:batchGenerateContent"
+EMBED_URL = f"{API_BASE_URL}/models/{EMBEDDING_MODEL_NAME}:embedContent"
+CACHED_CONTENTS_URL = f"{API_BASE_URL}/cachedContents"
+
 # --- Flask Setup ---
 app = Flask(__name__)
 
+# --- HTTP Client Setup ---
+# One long-lived event loop owns the shared HTTP/2 client, so keepalive connections
+# (and their TLS handshakes) are reused across requests. Flask views hand their
+# coroutines to this loop with run_async().
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, name="gemini-io", daemon=True).start()
+
+# httpx advertises (and decodes) gzip, plus Brotli when the brotli package is installed
+_client = httpx.AsyncClient(
+    http2=True,
+    timeout=60.0,
+    limits=httpx.Limits(max_keepalive_connections=16),
+    headers={"x-goog-api-key": GEMINI_API_KEY}
+)
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+GZIP_JSON_HEADERS = {**JSON_HEADERS, "Content-Encoding": "gzip"}
+# Bodies smaller than this don't shrink enough to be worth compressing
+GZIP_MIN_BYTES = 1024
+
+def run_async(coro):
+    """Runs a coroutine on the shared event loop and waits for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+def iterate_async(agen):
+    """Iterates an async generator on the shared event loop from synchronous code."""
+    async def next_item():
+        return await anext(agen, None)
+
+    async def close():
+        await agen.aclose()
+
+    try:
+        while (item := run_async(next_item())) is not None:
+            yield item
+    finally:
+        run_async(close())
+
+# --- Retries and Rate Limiting ---
+# Callers opt into retries per call. Transient failures (429s, 5xx and dropped connections)
+# are retried with jittered exponential backoff, waiting for the server's Retry-After when it
+# sends one. Calls that create resources don't retry a connection dropped mid-request, since
+# the server may already have acted on it. An AIMD limiter caps concurrent calls: it halves
+# once per burst of 429s and grows back by ~1 per round trip. A streamed call holds its slot
+# only until the response headers arrive, so the limiter paces how fast streams start rather
+# than how many bodies are open at once.
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_RETRY_AFTER_SECONDS = 60
+
+class AIMDLimiter:
+    """Async context manager that limits concurrent requests using additive-increase/multiplicative-decrease."""
+
+    def __init__(self, initial=8, minimum=1, maximum=32):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._last_decrease = float("-inf")
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_throttled(self, sent_at):
+        # 429s for requests sent before the last decrease belong to the same congestion event
+        if sent_at < self._last_decrease:
+            return
+        self.limit = max(self.minimum, self.limit / 2)
+        self._last_decrease = time.monotonic()
+
+_limiter = AIMDLimiter()
+_backoff = wait_exponential_jitter(initial=1, max=16)
+
+def is_retryable(e):
+    """Decides whether a failed Gemini request is worth retrying."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(e, httpx.TransportError)
+
+def is_retryable_create(e):
+    """Like is_retryable, but only retries connection failures that happened before the request was sent."""
+    if isinstance(e, httpx.TransportError):
+        return isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+    return is_retryable(e)
+
+def wait_before_retry(retry_state):
+    """Honors the Retry-After header when present, otherwise backs off exponentially with jitter."""
+    e = retry_state.outcome.exception()
+    if isinstance(e, httpx.HTTPStatusError):
+        try:
+            return min(float(e.response.headers.get("retry-after")), MAX_RETRY_AFTER_SECONDS)
+        except (TypeError, ValueError):
+            pass
+    return _backoff(retry_state)
+
+async def send_gemini(method, url, payload=None, stream=False, retry_on=None):
+    """Sends a request to the Gemini API, raising httpx.HTTPStatusError for error responses.
+
+    Failures for which retry_on returns True are retried; without it the request is tried once.
+    """
+    if retry_on is None:
+        return await send_gemini_once(method, url, payload, stream)
+
+    retrying = AsyncRetrying(stop=stop_after_attempt(4), wait=wait_before_retry, retry=retry_if_exception(retry_on), reraise=True)
+    return await retrying(send_gemini_once, method, url, payload, stream)
+
+async def send_gemini_once(method, url, payload, stream):
+    """Sends a single request to the Gemini API through the concurrency limiter."""
+    content, headers = None, None
+    if payload is not None:
+        content, headers = orjson.dumps(payload), JSON_HEADERS
+        if len(content) >= GZIP_MIN_BYTES:
+            content, headers = gzip.compress(content, compresslevel=6), GZIP_JSON_HEADERS
+
+    request = _client.build_request(method, url, content=content, headers=headers)
+    async with _limiter:
+        sent_at = time.monotonic()
+        response = await _client.send(request, stream=stream)
+
+    if response.is_error:
+        if stream:
+            await response.aread()
+            await response.aclose()
+        if response.status_code == 429:
+            _limiter.on_throttled(sent_at)
+        response.raise_for_status()
+
+    _limiter.on_success()
+    return response
+
+# --- Response Cache ---
+# Successful responses are cached on disk, keyed by a hash of the exact payload sent
+RESPONSE_CACHE_SECONDS = 86400
+_cache = diskcache.Cache("./.gemini_cache", size_limit=2**30)
+
+def payload_cache_key(payload):
+    """Builds a deterministic cache key for a Gemini request payload."""
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS, default=str)).hexdigest()
+
+# --- Semantic Cache ---
+# Whole reports are also cached by the embedding of their shopping query, so paraphrased
+# queries with the same budget reuse a report. Vectors are persisted in a diskcache.Index
+# and searched in memory; reports live in the response cache above and expire with it.
+# The live price sections are never stored, so they are regenerated on every hit.
+SEMANTIC_CACHE_THRESHOLD = 0.92
+EMBEDDING_DIMENSIONS = 256
+LIVE_REPORT_KEYS = ("price_trend_markdown", "price_tracker_markdown")
+_semantic_vectors = diskcache.Index("./.gemini_cache/semantic")
+# budget -> (index size, unit vector matrix, report cache keys), built lazily. The diskcache index
+# is shared by every Gunicorn worker, so a budget's matrix is rebuilt whenever its size changes.
+_semantic_index = {}
+
+def semantic_index_for(budget):
+    """Returns the in-memory vector matrix and report keys for one budget level."""
+    size = len(_semantic_vectors)
+    if budget not in _semantic_index or _semantic_index[budget][0] != size:
+        entries = []
+        for key in list(_semantic_vectors.keys()):
+            entry = _semantic_vectors.get(key)
+            if entry is None:
+                continue  # Pruned by another worker
+            if key not in _cache:
+                # The report has expired, so its vector is dropped as well
+                _semantic_vectors.pop(key, None)
+            elif entry[0] == budget:
+                entries.append((key, entry[1]))
+        matrix = np.array([vector for _, vector in entries], dtype=np.float32).reshape(-1, EMBEDDING_DIMENSIONS)
+        _semantic_index[budget] = (len(_semantic_vectors), matrix, [key for key, _ in entries])
+    return _semantic_index[budget][1:]
+
+def find_similar_report(query_vector, budget):
+    """Returns the cached report whose query is most similar to this one, if it is close enough."""
+    matrix, report_keys = semantic_index_for(budget)
+    if not report_keys:
+        return None
+
+    scores = matrix @ query_vector
+    # Walk the matches best first, so a report that expired since the last rebuild
+    # doesn't hide a valid one ranked below it
+    for index in np.argsort(scores)[::-1]:
+        if scores[index] < SEMANTIC_CACHE_THRESHOLD:
+            break
+        report = _cache.get(report_keys[index])
+        if report is not None:
+            return report
+        _semantic_vectors.pop(report_keys[index], None)
+    return None
+
+def store_similar_report(query_vector, budget, report):
+    """Adds a report, minus its live price sections, to the semantic cache under its query embedding."""
+    report_key = f"report:{hashlib.sha256(query_vector.tobytes()).hexdigest()}:{budget}"
+    stored_report = {key: section for key, section in report.items() if key not in LIVE_REPORT_KEYS}
+    _cache.set(report_key, stored_report, expire=RESPONSE_CACHE_SECONDS)
+    # The next lookup sees the new index size and rebuilds the matrix
+    _semantic_vectors[report_key] = (budget, query_vector.tolist())
+
+# --- Context Caching ---
+# Follow-up questions all resend the same recommendations context. The first question
+# about a context schedules a Gemini cachedContents entry holding it (plus the system
+# instruction and tools), and later questions reference that entry instead, so the
+# shared prefix is billed at the cached-token rate and isn't re-processed.
+CONTEXT_CACHE_TTL_SECONDS = 3600
+# Explicit caches need at least 1024 input tokens (~4 characters per token). A typical
+# three-product recommendations context is shorter than this, so in practice only long
+# contexts (detailed descriptions, pasted specs) take the cached path.
+CONTEXT_CACHE_MIN_CHARS = 4096
+# Statuses Gemini answers with when a referenced cache entry is missing or has expired
+CONTEXT_CACHE_MISSING_STATUS_CODES = {400, 403, 404}
+# A failed creation is remembered (as an empty name) for this long, so questions don't keep retrying it
+CONTEXT_CACHE_RETRY_SECONDS = 300
+_context_cache_tasks = {}  # context key -> in-flight creation task
+
+def context_cache_key(context):
+    """Builds the response-cache key that stores the Gemini cache name for a context."""
+    return f"context:{hashlib.sha256(context.encode()).hexdigest()}"
+
+async def create_context_cache(key, payload):
+    """Creates a Gemini cachedContents entry from a payload's contents, instruction and tools."""
+    try:
+        cached_content = {
+            "model": f"models/{GEMINI_MODEL_NAME}",
+            **payload,
+            "ttl": f"{CONTEXT_CACHE_TTL_SECONDS}s"
+        }
+        response = await send_gemini("POST", CACHED_CONTENTS_URL, cached_content, retry_on=is_retryable_create)
+        # Forget the name a little before Gemini expires the entry
+        _cache.set(key, orjson.loads(response.content)['name'], expire=CONTEXT_CACHE_TTL_SECONDS - 60)
+    except Exception as e:
+        logger.warning(f"Could not create context cache: {e}")
+        _cache.set(key, "", expire=CONTEXT_CACHE_RETRY_SECONDS)
+    finally:
+        _context_cache_tasks.pop(key, None)
+
+def cached_context_for(context, payload):
+    """Returns the Gemini cache name for a context, scheduling its creation the first time it is seen."""
+    if len(context) < CONTEXT_CACHE_MIN_CHARS:
+        return None
+
+    key = context_cache_key(context)
+    cache_name = _cache.get(key)
+    if cache_name is None and key not in _context_cache_tasks:
+        _context_cache_tasks[key] = asyncio.ensure_future(create_context_cache(key, payload))
+    return cache_name or None
+
+def log_cached_tokens(result):
+    """Logs how many input tokens Gemini served from its prefix cache."""
+    cached_tokens = result.get('usageMetadata', {}).get('cachedContentTokenCount')
+    if cached_tokens:
+        logger.info(f"Prefix cache hit: {cached_tokens} cached input tokens.")
+
 # --- Helper Functions ---
 
-def call_gemini_api(payload):
+# Shared preamble for every system instruction that asks for Markdown output
+_BASE_INSTRUCTION = "Respond in well-formed Markdown. "
+_GOOGLE_SEARCH_TOOLS = [{ "google_search": {} }]
+
+async def call_gemini_api(payload, use_cache=True):
     """Reusable function to call the Gemini API for text."""
+    key = payload_cache_key(payload) if use_cache else None
+    cached_text = _cache.get(key) if key is not None else None
+    if cached_text is not None:
+        return cached_text
+
     try:
-        apiUrl = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL_NAME}:generateContent?key={GEMINI_API_KEY}"
-        response = requests.post(
-            apiUrl, 
-            headers={'Content-Type': 'application/json'},
-            data=json.dumps(payload)
-        )
-        response.raise_for_status()
-        result = response.json()
+        response = await send_gemini("POST", GENERATE_URL, payload, retry_on=is_retryable)
+        result = orjson.loads(response.content)
+        log_cached_tokens(result)
         
         # Extract the raw text response
         text_string = result.get('candidates')[0]['content']['parts'][0]['text']
+        if key is not None:
+            _cache.set(key, text_string, expire=RESPONSE_CACHE_SECONDS)
         return text_string # Return raw text response
 
-    except requests.exceptions.HTTPError as e:
-        print(f"API HTTP Error: {e}")
+    except httpx.HTTPStatusError as e:
+        logger.error(f"API HTTP Error: {e}")
         error_message = f"Gemini API HTTP Error: {e.response.status_code}. Details: {e.response.text}"
-        return {"error": error_message}
+        return {"error": error_message, "status": e.response.status_code}
     except Exception as e:
-        print(f"An unexpected error occurred during AI generation: {e}")
+        logger.error(f"An unexpected error occurred during AI generation: {e}")
         return {"error": f"An unexpected error occurred during AI generation: {e}"}
 
-def generate_recommendations(prompt):
+async def embed_text(text):
+    """Returns the normalized Gemini embedding of a text, or None if it could not be computed."""
+    try:
+        payload = {
+            "content": { "parts": [{ "text": text }] },
+            "taskType": "SEMANTIC_SIMILARITY",
+            "outputDimensionality": EMBEDDING_DIMENSIONS
+        }
+        # Only a cache lookup depends on this, so it fails fast instead of retrying
+        response = await send_gemini("POST", EMBED_URL, payload)
+
+        vector = np.array(orjson.loads(response.content)['embedding']['values'], dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    except Exception as e:
+        logger.warning(f"Could not embed text for the semantic cache: {e}")
+        return None
+
+async def stream_gemini_api(payload, use_cache=True):
+    """Streams the Gemini API text response chunk by chunk as it is generated."""
+    key = payload_cache_key(payload) if use_cache else None
+    cached_text = _cache.get(key) if key is not None else None
+    if cached_text is not None:
+        yield cached_text
+        return
+
+    chunks = []
+    response = await send_gemini("POST", STREAM_GENERATE_URL, payload, stream=True, retry_on=is_retryable)
+    try:
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            result = orjson.loads(line[len("data:"):])
+            log_cached_tokens(result)
+            # Safety-blocked chunks can arrive with an empty candidates list
+            candidates = result.get('candidates') or [{}]
+            for part in candidates[0].get('content', {}).get('parts', []):
+                if part.get('text'):
+                    chunks.append(part['text'])
+                    yield part['text']
+    finally:
+        await response.aclose()
+
+    # An empty answer isn't worth replaying
+    if key is not None and chunks:
+        _cache.set(key, "".join(chunks), expire=RESPONSE_CACHE_SECONDS)
+
+# The system instruction and tools of each payload never change, so they are built once
+# here as templates; calls only add their "contents". Templates are shared, never mutate them.
+_RECOMMENDATIONS_TEMPLATE = {
+    "systemInstruction": { "parts": [{ "text": _BASE_INSTRUCTION + (
+        "You are an expert shopping assistant. Use Google Search for current products and pricing. "
+        "List 3 products, each as an H3 (###) Product Name, a detailed Description, and the Current Estimated Cost."
+    ) }] },
+    "tools": _GOOGLE_SEARCH_TOOLS # Google Search Grounding Enabled
+}
+
+async def generate_recommendations(prompt):
     """Generates the shopping recommendations as Markdown text with Google Search grounding."""
-    system_instruction = (
-        "You are an expert shopping assistant. Use the Google Search tool to find the most current products, pricing, and details. "
-        "Your final response MUST be a single, well-formatted Markdown list of 3 product recommendations. "
-        "For each recommendation, use an H3 heading (###) for the Product Name, followed by a detailed Description, and the Current Estimated Cost."
-    )
-    
-    payload = {
-        "contents": [{ "parts": [{ "text": prompt }] }],
-        "systemInstruction": { "parts": [{ "text": system_instruction }] },
-        "tools": [{ "google_search": {} }] # Google Search Grounding Enabled
-    }
-    return call_gemini_api(payload)
+    payload = {**_RECOMMENDATIONS_TEMPLATE, "contents": [{ "parts": [{ "text": prompt }] }]}
+    return await call_gemini_api(payload)
+
+_COMPARISON_TEMPLATE = {
+    "systemInstruction": { "parts": [{ "text": _BASE_INSTRUCTION + "You are a product analyst." }] },
+    "tools": _GOOGLE_SEARCH_TOOLS
+}
 
-def generate_comparison(recommendations_markdown):
+async def generate_comparison(recommendations_markdown):
     """Generates a side-by-side comparison table."""
     comparison_prompt = (
-        "Analyze the following list of product recommendations. Select the top two distinct products from this list. "
-        "Generate a detailed, two-column Markdown table that compares the two products based on key features, price, and pros/cons. "
-        "The comparison must be easy to read and structured as a Markdown table. "
+        "Select the top two distinct products from this list and compare them in one detailed, two-column table "
+        "on key features, price, and pros/cons.\n\n"
         "Product List:\n\n" + recommendations_markdown
     )
     
-    system_instruction = (
-        "You are a product analyst. Your response MUST be a single, detailed Markdown table comparing the two best products from the input."
-    )
-    
-    payload = {
-        "contents": [{ "parts": [{ "text": comparison_prompt }] }],
-        "systemInstruction": { "parts": [{ "text": system_instruction }] },
-        "tools": [{ "google_search": {} }] 
-    }
-    return call_gemini_api(payload)
+    payload = {**_COMPARISON_TEMPLATE, "contents": [{ "parts": [{ "text": comparison_prompt }] }]}
+    return await call_gemini_api(payload)
+
+_PRICE_TREND_TEMPLATE = {
+    "systemInstruction": { "parts": [{ "text": _BASE_INSTRUCTION + (
+        "You are a market analyst. Using Google Search for market trends, seasonal sales and launch cycles, "
+        "predict this product category's price trend over the next 60 days. "
+        "Give an H3 purchase recommendation, then a two-sentence trend summary."
+    ) }] },
+    "tools": _GOOGLE_SEARCH_TOOLS # Grounding required for market analysis
+}
 
-def generate_price_trend(prompt):
+def price_trend_payload(prompt):
+    """Builds the Gemini payload for the price trend analysis."""
+    return {**_PRICE_TREND_TEMPLATE, "contents": [{ "parts": [{ "text": prompt }] }]}
+
+async def generate_price_trend(prompt):
     """Generates a price trend analysis and purchase recommendation as a Markdown block."""
-    system_instruction = (
-        "You are a market analyst. Based on general market trends, seasonal sales cycles, and product launch patterns available via Google Search, "
-        "provide a summary of the likely price trend for this product category over the next 60 days and give a clear purchase recommendation. "
-        "Your response MUST be a concise Markdown block. Start with a clear heading (H3) for the recommendation, followed by a two-sentence summary of the trend."
-    )
-    
-    payload = {
-        "contents": [{ "parts": [{ "text": prompt }] }],
-        "systemInstruction": { "parts": [{ "text": system_instruction }] },
-        "tools": [{ "google_search": {} }] # Grounding required for market analysis
-    }
-    return call_gemini_api(payload)
+    # Market data should be fresh, so this call skips the response cache
+    return await call_gemini_api(price_trend_payload(prompt), use_cache=False)
 
-def generate_product_personas(recommendations_markdown):
-    """Generates a short persona/profile for each product in the list."""
+_PERSONAS_TEMPLATE = {
+    "systemInstruction": { "parts": [{ "text": _BASE_INSTRUCTION + "You are a creative marketing strategist." }] },
+    "tools": _GOOGLE_SEARCH_TOOLS
+}
+
+def product_personas_payload(recommendations_markdown):
+    """Builds the Gemini payload for the product persona profiles."""
     persona_prompt = (
-        "Analyze the following list of product recommendations. For each product, create a short, catchy 'Product Persona' "
-        "that summarizes the item's key appeal and target user in a memorable, two-sentence phrase. "
-        "Your response MUST be a single Markdown list with one bolded persona description per product using the product name as the heading."
+        "For each product below, write a catchy, two-sentence 'Product Persona' of its key appeal and target user, "
+        "as one list item headed by the bolded product name.\n\n"
         "Product List:\n\n" + recommendations_markdown
     )
     
-    system_instruction = (
-        "You are a creative marketing strategist. Your response must be a single Markdown list of personas."
-    )
-    
-    payload = {
-        "contents": [{ "parts": [{ "text": persona_prompt }] }],
-        "systemInstruction": { "parts": [{ "text": system_instruction }] },
-        "tools": [{ "google_search": {} }]
+    return {**_PERSONAS_TEMPLATE, "contents": [{ "parts": [{ "text": persona_prompt }] }]}
+
+async def generate_product_personas(recommendations_markdown):
+    """Generates a short persona/profile for each product in the list."""
+    return await call_gemini_api(product_personas_payload(recommendations_markdown))
+
+# Both outputs only analyze the given list, so this call uses schema-enforced JSON instead of
+# search grounding, and the instruction needs no format guardrails
+_COMPARE_AND_PERSONA_TEMPLATE = {
+    "systemInstruction": { "parts": [{ "text": "You are a product analyst and creative marketing strategist." }] },
+    "generationConfig": {
+        "responseMimeType": "application/json",
+        "responseSchema": {
+            "type": "OBJECT",
+            "properties": {
+                "comparison_markdown": { "type": "STRING" },
+                "persona_markdown": { "type": "STRING" }
+            },
+            "required": ["comparison_markdown", "persona_markdown"]
+        }
     }
-    return call_gemini_api(payload)
+}
+
+async def generate_compare_and_persona(recommendations_markdown):
+    """Generates the comparison table and the product personas with one call over the recommendations."""
+    prompt = (
+        "1. comparison_markdown: select the top two distinct products from this list and compare them in one detailed, "
+        "two-column Markdown table on key features, price, and pros/cons.\n"
+        "2. persona_markdown: for each product, a catchy, two-sentence 'Product Persona' of its key appeal and target user, "
+        "as one Markdown list item headed by the bolded product name.\n\n"
+        "Product List:\n\n" + recommendations_markdown
+    )
+
+    payload = {**_COMPARE_AND_PERSONA_TEMPLATE, "contents": [{ "parts": [{ "text": prompt }] }]}
+    text_string = await call_gemini_api(payload)
+    if isinstance(text_string, dict):
+        return text_string
+
+    try:
+        sections = orjson.loads(text_string)
+        return {"comparison_markdown": sections["comparison_markdown"], "persona_markdown": sections["persona_markdown"]}
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Could not parse comparison and personas: {e}")
+        return {"error": f"Could not parse comparison and personas: {e}"}
+
+_PRICE_TRACKER_TEMPLATE = {
+    "systemInstruction": { "parts": [{ "text": _BASE_INSTRUCTION + (
+        "You are a deal finder. Use Google Search to list the 3 lowest current prices for the product category "
+        "from major online retailers, each with the retailer and price (e.g., $299 on Amazon)."
+    ) }] },
+    "tools": _GOOGLE_SEARCH_TOOLS # Critical: Must use search for live price data
+}
+
+def price_tracker_payload(query):
+    """Builds the Gemini payload for the lowest price tracker."""
+    return {**_PRICE_TRACKER_TEMPLATE, "contents": [{ "parts": [{ "text": f"Find the three lowest prices for: {query}" }] }]}
 
 # FINAL FIX: Function to generate lowest price tracker (Markdown output)
-def generate_price_tracker(query):
+async def generate_price_tracker(query):
     """Finds the lowest price and retailer for the product category."""
-    system_instruction = (
-        "You are a deal finder. Use Google Search to find the current price and retailer for the product category specified by the user. "
-        "List the three lowest prices currently available from major online retailers. "
-        "Your response MUST be a clear Markdown list of the best 3 current deals, including the retailer name and the price details (e.g., $299 on Amazon)."
-    )
+    # Live prices should be fresh, so this call skips the response cache
+    return await call_gemini_api(price_tracker_payload(query), use_cache=False)
 
-def ask_product_ai(context, query):
-    """Answers follow-up questions about products using the provided context."""
-    system_instruction = (
-        "You are a helpful shopping assistant. Answer the user's question based on the product context provided. "
-        "Your response MUST be a clear, concise Markdown-formatted answer."
-    )
-    
-    payload = {
-        "contents": [{ "parts": [{ "text": f"Context: {context}\n\nQuestion: {query}" }] }],
-        "systemInstruction": { "parts": [{ "text": system_instruction }] },
-        "tools": [{ "google_search": {} }]
-    }
-    return call_gemini_api(payload)
-    
-    payload = {
-        "contents": [{ "parts": [{ "text": f"Find the three lowest prices for: {query}" }] }],
-        "systemInstruction": { "parts": [{ "text": system_instruction }] },
-        "tools": [{ "google_search": {} }] # Critical: Must use search for live price data
-    }
-    # Return Markdown text now
-    return call_gemini_api(payload)
+_PRODUCT_AI_TEMPLATE = {
+    "systemInstruction": { "parts": [{ "text": _BASE_INSTRUCTION + (
+        "You are a helpful shopping assistant. Concisely answer the user's question using the product context provided."
+    ) }] },
+    "tools": _GOOGLE_SEARCH_TOOLS
+}
 
+async def ask_product_ai(context, query, stream=False):
+    """Answers follow-up questions about products using the provided context.
 
-# --- Flask Routes ---
+    With stream=True the answer is returned as an async generator of Markdown chunks.
+    """
+    # The context leads and the question trails, so the cacheable prefix is identical across questions
+    context_payload = {**_PRODUCT_AI_TEMPLATE, "contents": [{ "role": "user", "parts": [{ "text": f"Context: {context}" }] }]}
+    question_content = { "role": "user", "parts": [{ "text": f"Question: {query}" }] }
 
-@app.route('/')
-def index():
-    return render_template("index.html")
+    payload = {**context_payload, "contents": context_payload["contents"] + [question_content]}
+    cache_name = cached_context_for(context, context_payload)
+    if cache_name is not None:
+        cached_payload = {"cachedContent": cache_name, "contents": [question_content]}
+        if stream:
+            return stream_with_cached_context(context, cached_payload, payload)
 
-@app.route('/get_recommendations', methods=['POST'])
-def get_recommendations():
-    data = request.json
-    shopping_query = data.get('shopping_query')
-    budget = data.get('budget')
+        answer_markdown = await call_gemini_api(cached_payload)
+        if not isinstance(answer_markdown, dict):
+            return answer_markdown
+        # Answer without the cache; only forget it if it has gone (other failures leave it in place,
+        # so a still-live entry isn't recreated and billed twice)
+        if answer_markdown.get("status") in CONTEXT_CACHE_MISSING_STATUS_CODES:
+            _cache.delete(context_cache_key(context))
 
-    if not all([shopping_query, budget]):
-        return jsonify({"error": "Missing form data"}), 400
+    if stream:
+        return stream_gemini_api(payload)
+    return await call_gemini_api(payload)
+
+async def stream_with_cached_context(context, cached_payload, payload):
+    """Streams an answer through the context cache, re-asking with the full payload if the cache entry is gone."""
+    chunks = stream_gemini_api(cached_payload)
+    try:
+        first_chunk = await anext(chunks, None)
+    except Exception as e:
+        # Answer without the cache; only forget it if it has gone, as in ask_product_ai
+        logger.warning(f"Context cache call failed, answering without it: {e}")
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code in CONTEXT_CACHE_MISSING_STATUS_CODES:
+            _cache.delete(context_cache_key(context))
+        chunks = stream_gemini_api(payload)
+        first_chunk = await anext(chunks, None)
 
-    # 1. Construct the Prompts
+    try:
+        if first_chunk is not None:
+            yield first_chunk
+            async for chunk in chunks:
+                yield chunk
+    finally:
+        await chunks.aclose()
+
+
+# --- Gemini Batch Mode ---
+# Sections that can arrive later are submitted as one batch job, billed at half the live rate
+
+async def submit_gemini_batch(requests_list):
+    """Submits (key, payload) pairs as one inline Gemini batch job and returns its name."""
+    try:
+        batch = {
+            "batch": {
+                "displayName": "shopping-assistant-extras",
+                "inputConfig": {
+                    "requests": {
+                        "requests": [{ "request": payload, "metadata": { "key": key } } for key, payload in requests_list]
+                    }
+                }
+            }
+        }
+        response = await send_gemini("POST", BATCH_GENERATE_URL, batch, retry_on=is_retryable_create)
+        return orjson.loads(response.content)['name']
+
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Batch API HTTP Error: {e}")
+        return {"error": f"Gemini Batch API HTTP Error: {e.response.status_code}. Details: {e.response.text}"}
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while submitting the batch: {e}")
+        return {"error": f"An unexpected error occurred while submitting the batch: {e}"}
+
+async def get_gemini_batch(batch_name):
+    """Returns the state of a batch job and, once it has finished, the text result per key."""
+    try:
+        response = await send_gemini("GET", f"{API_BASE_URL}/{batch_name}", retry_on=is_retryable)
+        batch = orjson.loads(response.content)
+
+        state = batch.get('metadata', {}).get('state', '')
+        if not state.endswith(("SUCCEEDED", "FAILED", "CANCELLED", "EXPIRED")):
+            return {"done": False, "state": state}
+
+        inlined = batch.get('response', {}).get('inlinedResponses', [])
+        if isinstance(inlined, dict):
+            inlined = inlined.get('inlinedResponses', [])
+
+        results = {}
+        for item in inlined:
+            key = item.get('metadata', {}).get('key')
+            try:
+                results[key] = item['response']['candidates'][0]['content']['parts'][0]['text']
+            except (KeyError, IndexError):
+                results[key] = {"error": f"Batch request '{key}' failed: {item.get('error')}"}
+        return {"done": True, "state": state, "results": results}
+
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Batch API HTTP Error: {e}")
+        return {"error": f"Gemini Batch API HTTP Error: {e.response.status_code}. Details: {e.response.text}"}
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while reading the batch: {e}")
+        return {"error": f"An unexpected error occurred while reading the batch: {e}"}
+
+# Clients only see a random token for their batch job. The token -> batch name map lives in the
+# response cache (shared by every worker), so nobody can read a job they didn't start by guessing its id.
+BATCH_TOKEN_SECONDS = 2 * 86400  # Batch jobs can take up to 24 hours
+# Tokens come from the client, so only plain ids are accepted
+BATCH_ID_PATTERN = re.compile(r"[\w-]+", re.ASCII)
+
+def register_batch(batch_name):
+    """Returns a new client-facing token for a submitted batch job."""
+    token = secrets.token_urlsafe(16)
+    _cache.set(f"batch:{token}", batch_name, expire=BATCH_TOKEN_SECONDS)
+    return token
+
+# Maps the batch request keys onto the keys returned to the frontend
+BATCH_REPORT_KEYS = {
+    "persona": "persona_markdown",
+    "trend": "price_trend_markdown",
+    "tracker": "price_tracker_markdown",
+}
+
+
+# Maps the keys of the combined report onto the keys returned to the frontend
+FULL_REPORT_KEYS = {
+    "recommendations": "recommendations_markdown",
+    "comparison": "comparison_markdown",
+    "personas": "persona_markdown",
+    "price_trend": "price_trend_markdown",
+    "price_tracker": "price_tracker_markdown",
+}
+
+def parse_json_text(text_string):
+    """Parses a JSON object from model output, tolerating a surrounding ```json fence."""
+    match = re.search(r"```(?:json)?\s*(.*?)\s*```", text_string, re.DOTALL)
+    return orjson.loads(match.group(1) if match else text_string)
+
+# Search grounding can't be combined with responseMimeType/responseSchema on this model,
+# so the JSON shape is enforced through the instruction and validated after the call instead.
+_FULL_REPORT_TEMPLATE = {
+    "systemInstruction": { "parts": [{ "text": (
+        "You are an expert shopping assistant. Use the Google Search tool to find the most current products, pricing, deals and market trends. "
+        "Your final response MUST be a single JSON object (no surrounding text) with exactly these five string fields, each holding Markdown:\n"
+        "- \"recommendations\": a Markdown list of 3 product recommendations. For each, use an H3 heading (###) for the Product Name, followed by a detailed Description, and the Current Estimated Cost.\n"
+        "- \"comparison\": a detailed two-column Markdown table comparing the top two distinct recommended products on key features, price, and pros/cons.\n"
+        "- \"personas\": a Markdown list with one bolded, catchy two-sentence 'Product Persona' per recommended product, using the product name as the heading.\n"
+        "- \"price_trend\": a concise Markdown block with an H3 heading giving a clear purchase recommendation, followed by a two-sentence summary of the likely price trend for this product category over the next 60 days.\n"
+        "- \"price_tracker\": a Markdown list of the three lowest current prices from major online retailers, including the retailer name and the price details (e.g., $299 on Amazon)."
+    ) }] },
+    "tools": _GOOGLE_SEARCH_TOOLS
+}
+
+async def generate_full_report(shopping_query, budget):
+    """Generates all five report sections with a single grounded Gemini call."""
+    prompt = (
+        f"Find product recommendations for: '{shopping_query}'. "
+        f"The user's budget level is '{budget}'. "
+        "Find the best 3 options that match this request and build the full report."
+    )
+
+    payload = {**_FULL_REPORT_TEMPLATE, "contents": [{ "parts": [{ "text": prompt }] }]}
+    # The report carries the live price trend and tracker sections, so this call skips the response cache
+    text_string = await call_gemini_api(payload, use_cache=False)
+    if isinstance(text_string, dict):
+        return text_string
+
+    try:
+        sections = parse_json_text(text_string)
+        report = {response_key: sections[key] for key, response_key in FULL_REPORT_KEYS.items()}
+        if not all(isinstance(section, str) for section in report.values()):
+            raise ValueError("every section must be a Markdown string")
+        return report
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Could not parse combined report: {e}")
+        return {"error": f"Could not parse combined report: {e}"}
+
+def build_prompts(shopping_query, budget):
+    """Builds the recommendation and price trend prompts for the individual helpers."""
     recommendation_prompt = (
         f"Find product recommendations for: '{shopping_query}'. "
         f"The user's budget level is '{budget}'. "
@@ -172,58 +728,304 @@ def get_recommendations():
     price_trend_prompt = (
         f"Analyze the market for products matching the description: '{shopping_query}'."
     )
+    return recommendation_prompt, price_trend_prompt
+
+async def build_report(shopping_query, budget):
+    """Builds every report section, reusing a cached report for near-duplicate queries."""
+    # Generation starts alongside the embedding lookup so a cache miss costs no extra round trip;
+    # a cache hit cancels it
+    generation = asyncio.ensure_future(generate_report(shopping_query, budget))
+    try:
+        query_vector = await embed_text(shopping_query)
+        if query_vector is not None:
+            cached_report = find_similar_report(query_vector, budget)
+            if cached_report is not None:
+                logger.info("Serving report from the semantic cache.")
+                generation.cancel()
+                return {**cached_report, **await generate_live_sections(shopping_query, budget)}
+
+        report = await generation
+    finally:
+        generation.cancel()
+
+    # Only fully successful reports are worth reusing
+    if query_vector is not None and "error" not in report and all(isinstance(section, str) for section in report.values()):
+        store_similar_report(query_vector, budget, report)
+    return report
+
+async def generate_live_sections(shopping_query, budget):
+    """Generates the price trend and price tracker sections, which are never served from a cache."""
+    _, price_trend_prompt = build_prompts(shopping_query, budget)
+    price_trend_markdown, price_tracker_markdown = await asyncio.gather(
+        generate_price_trend(price_trend_prompt),
+        generate_price_tracker(shopping_query),
+    )
+    return {"price_trend_markdown": price_trend_markdown, "price_tracker_markdown": price_tracker_markdown}
+
+async def generate_report(shopping_query, budget):
+    """Generates every report section, preferring the combined call over the individual helpers."""
+    report = await generate_full_report(shopping_query, budget)
+    if "error" not in report:
+        return report
+
+    logger.warning("Combined report unavailable, falling back to individual calls.")
+
+    recommendation_prompt, price_trend_prompt = build_prompts(shopping_query, budget)
+
+    # Trend and tracker don't depend on the recommendations, so run them alongside it
+    recommendations_markdown, price_trend_markdown, price_tracker_markdown = await asyncio.gather(
+        generate_recommendations(recommendation_prompt),
+        generate_price_trend(price_trend_prompt),
+        generate_price_tracker(shopping_query),  # FINAL FIX: Price Tracker Data as Markdown
+    )
 
-    print(f"Sending grounded prompt to Gemini for Recommendations.")
-    
-    # 2. Call the AI Models 
-    recommendations_markdown = generate_recommendations(recommendation_prompt)
-    
     if isinstance(recommendations_markdown, dict) and "error" in recommendations_markdown:
-        return jsonify(recommendations_markdown), 500
+        return recommendations_markdown
+
+    return {
+        "recommendations_markdown": recommendations_markdown,
+        "price_trend_markdown": price_trend_markdown,
+        "price_tracker_markdown": price_tracker_markdown,
+        **await generate_dependent_sections(recommendations_markdown),
+    }
+
+async def generate_dependent_sections(recommendations_markdown):
+    """Generates the comparison and persona sections, falling back to separate calls if the combined one fails."""
+    sections = await generate_compare_and_persona(recommendations_markdown)
+    if "error" in sections:
+        sections["comparison_markdown"], sections["persona_markdown"] = await asyncio.gather(
+            generate_comparison(recommendations_markdown),
+            generate_product_personas(recommendations_markdown),
+        )
+        del sections["error"]
+    return sections
 
-    comparison_markdown = generate_comparison(recommendations_markdown)
-    if isinstance(comparison_markdown, dict) and "error" in comparison_markdown:
-        comparison_markdown = "Comparison failed, but recommendations were successful."
+async def stream_report(shopping_query, budget):
+    """Yields report sections (as partial report dicts) as soon as each one is ready.
 
-    persona_markdown = generate_product_personas(recommendations_markdown)
-    if isinstance(persona_markdown, dict) and "error" in persona_markdown:
-        persona_markdown = "### Persona Analysis Unavailable"
+    Unlike build_report this never tries generate_full_report, trading its one call for
+    separate calls whose sections can be shown as they arrive (the page's single request mode uses build_report).
+    """
+    recommendation_prompt, price_trend_prompt = build_prompts(shopping_query, budget)
 
-    price_trend_markdown = generate_price_trend(price_trend_prompt)
-    if isinstance(price_trend_markdown, dict) and "error" in price_trend_markdown:
-        price_trend_markdown = "### Price Trend Analysis Unavailable\n\nCould not access live market data for price trend prediction. Please check retail sites for current sales."
+    # asyncio.wait rather than as_completed: the dependent sections join the pending
+    # set once the recommendations arrive. The live price sections always run, even on a cache hit,
+    # and the recommendations start alongside the embedding lookup, to be cancelled on a hit.
+    recommendations = asyncio.ensure_future(generate_recommendations(recommendation_prompt))
+    pending = {
+        recommendations: "recommendations_markdown",
+        asyncio.ensure_future(generate_price_trend(price_trend_prompt)): "price_trend_markdown",
+        asyncio.ensure_future(generate_price_tracker(shopping_query)): "price_tracker_markdown",
+    }
+    report = {}
+    try:
+        query_vector = await embed_text(shopping_query)
+        cached_report = find_similar_report(query_vector, budget) if query_vector is not None else None
+        if cached_report is not None:
+            logger.info("Serving report from the semantic cache.")
+            del pending[recommendations]
+            recommendations.cancel()
+            yield cached_report
 
-    # FINAL FIX: Generate Price Tracker Data as Markdown
-    price_tracker_markdown = generate_price_tracker(shopping_query)
-    if isinstance(price_tracker_markdown, dict) and "error" in price_tracker_markdown:
-        price_tracker_markdown = "Could not find a current price breakdown from major retailers."
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                key = pending.pop(task)
+                result = task.result()
 
+                if key is None:
+                    section = result  # comparison and personas arrive together
+                elif key == "recommendations_markdown" and isinstance(result, dict) and "error" in result:
+                    yield result
+                    return
+                else:
+                    section = {key: result}
+                    if key == "recommendations_markdown":
+                        pending[asyncio.ensure_future(generate_dependent_sections(result))] = None
 
-    # 3. Return the data
-    return jsonify({
+                report.update(section)
+                yield section
+    finally:
+        for task in pending:
+            task.cancel()
+
+    # Only fully successful reports are worth reusing
+    if query_vector is not None and cached_report is None and all(isinstance(section, str) for section in report.values()):
+        store_similar_report(query_vector, budget, report)
+
+
+async def build_report_with_batch(shopping_query, budget):
+    """Builds the live sections now and submits the persona, price trend and price tracker sections as a batch job."""
+    recommendation_prompt, price_trend_prompt = build_prompts(shopping_query, budget)
+
+    recommendations_markdown = await generate_recommendations(recommendation_prompt)
+
+    if isinstance(recommendations_markdown, dict) and "error" in recommendations_markdown:
+        return recommendations_markdown
+
+    comparison_markdown, batch_name = await asyncio.gather(
+        generate_comparison(recommendations_markdown),
+        submit_gemini_batch([
+            ("persona", product_personas_payload(recommendations_markdown)),
+            ("trend", price_trend_payload(price_trend_prompt)),
+            ("tracker", price_tracker_payload(shopping_query)),
+        ]),
+    )
+
+    report = {
         "recommendations_markdown": recommendations_markdown,
         "comparison_markdown": comparison_markdown,
-        "price_trend_markdown": price_trend_markdown,
-        "persona_markdown": persona_markdown,
-        "price_tracker_markdown": price_tracker_markdown # NOW MARKDOWN
-    })
+    }
+    if isinstance(batch_name, dict):
+        # Batch submission failed, so fall back to the live calls
+        report["persona_markdown"], report["price_trend_markdown"], report["price_tracker_markdown"] = await asyncio.gather(
+            generate_product_personas(recommendations_markdown),
+            generate_price_trend(price_trend_prompt),
+            generate_price_tracker(shopping_query),
+        )
+    else:
+        report["batch_id"] = register_batch(batch_name)
+    return report
+
+
+# Text shown in place of a section whose generation failed
+REPORT_FALLBACKS = {
+    "comparison_markdown": "Comparison failed, but recommendations were successful.",
+    "persona_markdown": "### Persona Analysis Unavailable",
+    "price_trend_markdown": "### Price Trend Analysis Unavailable\n\nCould not access live market data for price trend prediction. Please check retail sites for current sales.",
+    "price_tracker_markdown": "Could not find a current price breakdown from major retailers.",
+}
+
+def apply_report_fallbacks(report):
+    """Replaces failed report sections with their user-facing fallback text."""
+    for key, fallback in REPORT_FALLBACKS.items():
+        if isinstance(report.get(key), dict) and "error" in report[key]:
+            report[key] = fallback
+    return report
+
+
+def json_response(data, status=200):
+    """Serializes a route's result with orjson instead of Flask's jsonify."""
+    return Response(orjson.dumps(data), status=status, mimetype="application/json")
+
+
+# --- Request Schemas ---
+# Request bodies are decoded and validated in one pass by msgspec
+
+NonEmptyStr = Annotated[str, msgspec.Meta(min_length=1)]
+
+class RecQuery(msgspec.Struct):
+    """Body of /get_recommendations."""
+    shopping_query: NonEmptyStr
+    budget: NonEmptyStr
+    batch_extras: bool = False
+
+class AskQuery(msgspec.Struct):
+    """Body of /ask_product_ai."""
+    context: NonEmptyStr
+    query: NonEmptyStr
+
+
+# --- Flask Routes ---
 
-# Route for Follow-up Questions (unchanged)
+@app.route('/')
+def index():
+    return render_template("index.html")
+
+@app.route('/get_recommendations', methods=['POST'])
+def get_recommendations():
+    try:
+        data = msgspec.json.decode(request.get_data(), type=RecQuery)
+    except msgspec.DecodeError:
+        return json_response({"error": "Missing form data"}, 400)
+    shopping_query = data.shopping_query
+    budget = data.budget
+
+    logger.info("Sending grounded prompt to Gemini for Recommendations.")
+
+    # 2. Call the AI Models (optionally deferring the extras to a cheaper batch job)
+    if data.batch_extras:
+        report = run_async(build_report_with_batch(shopping_query, budget))
+    elif request.accept_mimetypes.best == "application/x-ndjson":
+        # Stream each section as one JSON line as soon as it is ready. This uses the individual calls
+        # rather than the single combined call, which returns only once the whole report is done;
+        # the page's single request mode asks for plain JSON to get the combined call instead.
+        return Response(stream_report_lines(stream_report(shopping_query, budget)), mimetype="application/x-ndjson")
+    else:
+        report = run_async(build_report(shopping_query, budget))
+    if "error" in report:
+        return json_response(report, 500)
+
+    # 3. Return the data
+    return json_response(apply_report_fallbacks(report))
+
+# Route for polling the batch job started by /get_recommendations
+@app.route('/batch_status/<batch_id>')
+def batch_status(batch_id):
+    if not BATCH_ID_PATTERN.fullmatch(batch_id):
+        return json_response({"error": "Invalid batch id."}, 400)
+
+    batch_name = _cache.get(f"batch:{batch_id}")
+    if batch_name is None:
+        return json_response({"error": "Unknown or expired batch id."}, 404)
+
+    batch = run_async(get_gemini_batch(batch_name))
+    if "error" in batch:
+        return json_response(batch, 502)
+
+    if not batch["done"]:
+        return json_response({"done": False, "state": batch["state"]})
+
+    report = {response_key: batch["results"].get(key, {"error": "Missing from batch results."})
+              for key, response_key in BATCH_REPORT_KEYS.items()}
+    return json_response({"done": True, "state": batch["state"], **apply_report_fallbacks(report)})
+
+def client_error_message(e):
+    """Describes a failed streamed call for the client; the exception itself (which can include the request URL) stays in the logs."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return f"Gemini API HTTP Error: {e.response.status_code}."
+    return "An unexpected error occurred during AI generation."
+
+def stream_report_lines(sections):
+    """Writes streamed report sections as newline-delimited JSON."""
+    try:
+        for section in iterate_async(sections):
+            yield orjson.dumps(apply_report_fallbacks(section)) + b"\n"
+    except Exception as e:
+        logger.error(f"Report Streaming Error: {e}")
+        yield orjson.dumps({"error": client_error_message(e)}) + b"\n"
+
+def stream_answer_events(chunks):
+    """Wraps streamed answer chunks as Server-Sent Events, ending with a done (or error) event."""
+    try:
+        for chunk in iterate_async(chunks):
+            yield f"data: {orjson.dumps(chunk).decode()}\n\n"
+        yield "event: done\ndata: {}\n\n"
+    except Exception as e:
+        logger.error(f"API Streaming Error: {e}")
+        yield f"event: error\ndata: {orjson.dumps(client_error_message(e)).decode()}\n\n"
+
+# Route for Follow-up Questions
 @app.route('/ask_product_ai', methods=['POST'])
 def ask_ai_route():
-    data = request.json
-    context = data.get('context')
-    query = data.get('query')
+    try:
+        data = msgspec.json.decode(request.get_data(), type=AskQuery)
+    except msgspec.DecodeError:
+        return json_response({"error": "Missing context or query."}, 400)
+    context = data.context
+    query = data.query
 
-    if not context or not query:
-        return jsonify({"error": "Missing context or query."}), 400
+    # Clients that accept Server-Sent Events get the answer token by token
+    if request.accept_mimetypes.best == "text/event-stream":
+        chunks = run_async(ask_product_ai(context, query, stream=True))
+        return Response(stream_answer_events(chunks), mimetype="text/event-stream")
 
-    answer_markdown = ask_product_ai(context, query)
+    answer_markdown = run_async(ask_product_ai(context, query))
 
     if isinstance(answer_markdown, dict) and "error" in answer_markdown:
-        return jsonify(answer_markdown), 500
+        return json_response(answer_markdown, 500)
     
-    return jsonify({"answer_markdown": answer_markdown})
+    return json_response({"answer_markdown": answer_markdown})
 
 
 if __name__ == '__main__':
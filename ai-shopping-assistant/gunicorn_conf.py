@@ -0,0 +1,23 @@
+# Gunicorn settings for serving the shopping assistant in production.
+# Run from this directory with:  gunicorn -c gunicorn_conf.py app:app
+import os
+import multiprocessing
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+
+# Gemini I/O already runs on each worker's shared asyncio loop (see run_async in app.py);
+# request threads only wait on its futures, so cheap threads scale to many concurrent
+# users. gevent workers are avoided on purpose: monkey-patching threading would turn
+# that event loop thread into a greenlet and mix two schedulers.
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", min(4, multiprocessing.cpu_count())))
+threads = int(os.getenv("GUNICORN_THREADS", "100"))
+
+# Each worker must import the app itself so it starts its own event loop thread
+# and HTTP client; threads don't survive the fork that preloading would do first.
+preload_app = False
+
+# Grounded Gemini calls (with retries) can take a while; streamed answers stay open longer
+timeout = 180
+graceful_timeout = 30
+keepalive = 5